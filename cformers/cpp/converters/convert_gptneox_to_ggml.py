@@ -9,6 +9,8 @@
 
 import io
 import os
+import functools
+import importlib.util
 import sys
 import struct
 import json
@@ -16,9 +18,14 @@ import code
 import torch
 import numpy as np
 
+from concurrent.futures import ThreadPoolExecutor
 from transformers import AutoModelForCausalLM, AutoTokenizer
 
+PACK_I = struct.Struct("i").pack
+OUT_BUFFER_SIZE = 8*1024*1024
+
 # ref: https://github.com/openai/gpt-2/blob/master/src/encoder.py
+@functools.lru_cache()
 def bytes_to_unicode():
     """
     Returns list of utf-8 byte and a corresponding list of unicode strings.
@@ -40,11 +47,17 @@ def bytes_to_unicode():
     cs = [chr(n) for n in cs]
     return dict(zip(bs, cs))
 
+# per-tensor progress is only printed with -v
+VERBOSE = "-v" in sys.argv
+if VERBOSE:
+    sys.argv.remove("-v")
+
 if len(sys.argv) < 3:
-    print("Usage: python convert-hf-to-ggml.py model_name dir-output [use-f32]")
+    print("Usage: python convert-hf-to-ggml.py model_name dir-output [use-f32] [-v]")
     print("  model_name: name of the model to convert. Example: 'bigscience/bloomz-560m'")
     print("  dir-output: directory where the output file will be written")
     print("  use-f32:    if present, use float32 instead of float16")
+    print("  -v:         print every tensor as it is converted")
     sys.exit(1)
 
 model_name = sys.argv[1]
@@ -63,41 +76,54 @@ ftype = 1
 if len(sys.argv) > 3:
     ftype = 0
 
+# set GGML_CONVERT_VERIFY=1 to sanity check the QKV split of every layer
+VERIFY = bool(os.environ.get("GGML_CONVERT_VERIFY"))
+
 tokenizer = AutoTokenizer.from_pretrained(model_name)
 print("Loading model: ", model_name)
-model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float16 if ftype == 1 else torch.float32)
+# low_cpu_mem_usage needs accelerate; without it fall back to a plain load
+low_cpu_mem_usage = importlib.util.find_spec("accelerate") is not None
+model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float16 if ftype == 1 else torch.float32,
+                                             low_cpu_mem_usage=low_cpu_mem_usage)
 model.eval()
-for p in model.parameters():
-    p.requires_grad = False
+model.requires_grad_(False)
 hparams = model.config.to_dict()
 print("Model loaded: ", model_name)
 
 
 fname_out = dir_out + f"/ggml-model-{model_name.split('/')[-1]}-{ftype_str[ftype]}.bin"
-fout = open(fname_out, "wb")
+fout = open(fname_out, "wb", buffering=OUT_BUFFER_SIZE)
 
 hparams["multiple_of"] = 1
-fout.write(struct.pack("i", 0x67676d6c)) # magic: ggml in hex
-fout.write(struct.pack("i", hparams["vocab_size"]))
-# fout.write(struct.pack("i", hparams["seq_length"]))
-fout.write(struct.pack("i", hparams["hidden_size"]))
-fout.write(struct.pack("i", hparams["num_attention_heads"]))
-fout.write(struct.pack("i", hparams["num_hidden_layers"]))
+fout.write(PACK_I(0x67676d6c)) # magic: ggml in hex
+fout.write(PACK_I(hparams["vocab_size"]))
+# fout.write(PACK_I(hparams["seq_length"]))
+fout.write(PACK_I(hparams["hidden_size"]))
+fout.write(PACK_I(hparams["num_attention_heads"]))
+fout.write(PACK_I(hparams["num_hidden_layers"]))
 # TODO: Check if this is correct.
-fout.write(struct.pack("i", int((hparams["hidden_size"] / hparams["num_attention_heads"]
-                             ) * hparams["rotary_pct"]))) # rotary_dim
-fout.write(struct.pack("i", int(hparams["use_parallel_residual"])))
+fout.write(PACK_I(int((hparams["hidden_size"] / hparams["num_attention_heads"]
+                      ) * hparams["rotary_pct"]))) # rotary_dim
+fout.write(PACK_I(int(hparams["use_parallel_residual"])))
 
-fout.write(struct.pack("i", ftype))
+fout.write(PACK_I(ftype))
 
 # Is this correct??
 dot_token = tokenizer.encode(".")[0]
-for i in range(hparams["vocab_size"]):
-    text = tokenizer.decode([i]).encode('utf-8')
-    fout.write(struct.pack("i", len(text)))
-    fout.write(text)
+# decode every token, then emit the whole vocab with a single write
+texts = [tokenizer.decode([i]) for i in range(hparams["vocab_size"])]
+vocab_buf = bytearray()
+for text in texts:
+    text = text.encode('utf-8')
+    vocab_buf += PACK_I(len(text))
+    vocab_buf += text
+fout.write(vocab_buf)
+del texts, vocab_buf
 
 list_vars = model.state_dict()
+# list_vars now holds the only references to the weights, so each tensor can
+# be released as soon as it is no longer needed
+del model
 
 # All the `gpt_neox.layers.<LAYER_ID>.attention.query_key_value.weight` layers
 # Should be split into 3 layers:
@@ -105,123 +131,133 @@ list_vars = model.state_dict()
 #  gpt_neox.layers.<LAYER_ID>.attention.key.weight
 #  gpt_neox.layers.<LAYER_ID>.attention.value.weight
 # Similarly split `gpt_neox.layers.<LAYER_ID>.attention.query_key_value.bias`.
-new_list_vars = list_vars.copy()
-with torch.no_grad():
-    for layer in range(hparams["num_hidden_layers"]):
-        weight_key = "gpt_neox.layers." + str(layer) + ".attention.query_key_value.weight"
-        bias_key = "gpt_neox.layers." + str(layer) + ".attention.query_key_value.bias"
-
-        # Reverse engineering: https://github.com/huggingface/transformers/blob/c07a02a4b7892edfee22cbe57d3cdd9e10ae7a4d/src/transformers/models/gpt_neox/modeling_gpt_neox.py#LL115-L125
-        # "View" in pytorch makes it hard to simply extract q, k, v from the matrix.
-        qkv_matrix = list_vars[weight_key]
-        qkv_bias = list_vars[bias_key]
-        qkv_linear = torch.nn.Linear(hparams["hidden_size"], hparams["hidden_size"] * 3)
-        qkv_linear.weight.data = qkv_matrix.float()
-        qkv_linear.bias.data = qkv_bias.float()
-        head_size = hparams["hidden_size"] // hparams["num_attention_heads"]
-
-        # Get Wq_x_plus_bq, Wk_x_plus_bk, Wv_x_plus_bv
-        identityMatrix = torch.eye(hparams["hidden_size"]) # pylint: disable=no-member
-        qkv = qkv_linear(identityMatrix).unsqueeze(0)
-        new_qkv_shape = qkv.size()[:-1] + (hparams["num_attention_heads"], 3 * head_size)
-        qkv = qkv.view(*new_qkv_shape)
-        Wq_x_plus_bq = qkv[..., :head_size]
-        Wk_x_plus_bk = qkv[..., head_size:2*head_size]
-        Wv_x_plus_bv = qkv[..., 2*head_size:]
-
-        #   [batch, seq_len, num_heads, 3 * head_size] -> [batch, seq_len, (num_heads * 3 * head_size)]
-        new_shape = Wq_x_plus_bq.size()[:-2] + (Wq_x_plus_bq.size(-2) * Wq_x_plus_bq.size(-1),)
-        Wq_x_plus_bq = Wq_x_plus_bq.contiguous().view(*new_shape).squeeze(0)
-        Wk_x_plus_bk = Wk_x_plus_bk.contiguous().view(*new_shape).squeeze(0)
-        Wv_x_plus_bv = Wv_x_plus_bv.contiguous().view(*new_shape).squeeze(0)
-
-        # Get bq, bk, bv
-        zeroMatrix = torch.zeros(hparams["hidden_size"], hparams["hidden_size"]) # pylint: disable=no-member
-        qkv = qkv_linear(zeroMatrix).unsqueeze(0)
-        new_qkv_shape = qkv.size()[:-1] + (hparams["num_attention_heads"], 3 * head_size)
-        qkv = qkv.view(*new_qkv_shape)
-        bq = qkv[..., :head_size]
-        bk = qkv[..., head_size:2*head_size]
-        bv = qkv[..., 2*head_size:]
-
-        #   [batch, seq_len, num_heads, 3 * head_size] -> [batch, seq_len, (num_heads * 3 * head_size)]
-        new_shape = bq.size()[:-2] + (bq.size(-2) * bq.size(-1),)
-        bq = bq.contiguous().view(*new_shape)[0, 0, :]
-        bk = bk.contiguous().view(*new_shape)[0, 0, :]
-        bv = bv.contiguous().view(*new_shape)[0, 0, :]
-
-        # Get Wq_x, Wk_x, Wv_x
-        Wq_x = (Wq_x_plus_bq - bq).T
-        Wk_x = (Wk_x_plus_bk - bk).T
-        Wv_x = (Wv_x_plus_bv - bv).T
-
-        # Sanity check that the split is correct
-        dummy_linear = torch.nn.Linear(hparams["hidden_size"], hparams["hidden_size"])
-
-        dummy_linear.weight.data = Wq_x.float()
-        dummy_linear.bias.data = bq.float()
-        assert torch.allclose(Wq_x_plus_bq, dummy_linear(identityMatrix).unsqueeze(0))
-
-        dummy_linear.weight.data = Wk_x.float()
-        dummy_linear.bias.data = bk.float()
-        assert torch.allclose(Wk_x_plus_bk, dummy_linear(identityMatrix).unsqueeze(0))
-
-        dummy_linear.weight.data = Wv_x.float()
-        dummy_linear.bias.data = bv.float()
-        assert torch.allclose(Wv_x_plus_bv, dummy_linear(identityMatrix).unsqueeze(0))
-
-        # Save the new weights and biases
-        new_list_vars["gpt_neox.layers." + str(layer) + ".attention.query.weight"] = Wq_x
-        new_list_vars["gpt_neox.layers." + str(layer) + ".attention.key.weight"] = Wk_x
-        new_list_vars["gpt_neox.layers." + str(layer) + ".attention.value.weight"] = Wv_x
-        new_list_vars["gpt_neox.layers." + str(layer) + ".attention.query.bias"] = bq
-        new_list_vars["gpt_neox.layers." + str(layer) + ".attention.key.bias"] = bk
-        new_list_vars["gpt_neox.layers." + str(layer) + ".attention.value.bias"] = bv
-
-        # Delete the old weights and biases
-        del new_list_vars[weight_key]
-        del new_list_vars[bias_key]
-
-list_vars = new_list_vars
-
-for name in list_vars.keys():
-    if name.startswith('gpt_neox.layers.'):
-        if 'attention.masked_bias' in name or \
-            'attention.rotary_emb.inv_freq' in name or \
-            'attention.bias' in name:
-            continue
-    # No gradients for these
-    list_vars[name].requires_grad = False
-    src = name
-    nn = name
-
-    print(src, ' -> ', name)
-    data = list_vars[src].squeeze().numpy()
-    data = data.astype(np.float32)
-
-    n_dims = len(data.shape)
-    print(name, n_dims, data.shape)
+# The gpt-neox loader in main.cpp maps these three names to separate q/k/v
+# tensors and rejects unknown names, so a fused layout can't be written here
+# until the loader and eval graph learn to read it. The split is not free:
+# q, k and v are strided slices of the fused weight, so reshaping them copies,
+# costing one extra copy of each layer's QKV weights while that layer is split.
+hidden_size = hparams["hidden_size"]
+num_heads = hparams["num_attention_heads"]
+head_size = hidden_size // num_heads
+
+@functools.lru_cache()
+def header_struct(n_dims):
+    # n_dims, name length, ftype, then the shape in reverse order
+    return struct.Struct(f"iii{n_dims}i")
+
+def write_tensor(fout, header, data):
+    """
+    Writes a tensor header followed by the contiguous numpy array `data`.
+    Tensors larger than the output buffer are sent with a single gathered
+    os.writev() straight from the array memory; small ones are copied into
+    the file's buffer (fout.write, not tofile, which bypasses it) so they
+    are flushed together with their neighbours.
+    """
+    if not hasattr(os, "writev") or data.nbytes < OUT_BUFFER_SIZE:
+        fout.write(header)
+        fout.write(data)
+        return
+
+    fout.flush()
+    fd = fout.fileno()
+    bufs = [memoryview(header), memoryview(data.reshape(-1).view(np.uint8))]
+    while bufs:
+        n = os.writev(fd, bufs)
+        # writev may stop short, resume from where it left off
+        while bufs and n >= len(bufs[0]):
+            n -= len(bufs[0])
+            bufs.pop(0)
+        if n:
+            bufs[0] = bufs[0][n:]
+
+def split_layer(layer, qkv_matrix, qkv_bias):
+    # Reverse engineering: https://github.com/huggingface/transformers/blob/c07a02a4b7892edfee22cbe57d3cdd9e10ae7a4d/src/transformers/models/gpt_neox/modeling_gpt_neox.py#LL115-L125
+    # The fused output is viewed as [num_heads, 3 * head_size], so the rows of the
+    # weight (and the bias) are laid out as [num_heads, 3, head_size]. Slicing that
+    # view gives q, k, v directly without running the matrix through a Linear.
+    # (grad mode is thread-local, so no_grad has to be entered in the worker)
+    with torch.no_grad():
+        W = qkv_matrix.view(num_heads, 3, head_size, hidden_size)
+        b = qkv_bias.view(num_heads, 3, head_size)
+
+        Wq_x = W[:, 0].reshape(num_heads * head_size, hidden_size)
+        Wk_x = W[:, 1].reshape(num_heads * head_size, hidden_size)
+        Wv_x = W[:, 2].reshape(num_heads * head_size, hidden_size)
+        bq = b[:, 0].reshape(-1)
+        bk = b[:, 1].reshape(-1)
+        bv = b[:, 2].reshape(-1)
+
+        # Sanity check that the split is correct. The split itself stays in the
+        # checkpoint dtype; only this opt-in check upcasts, since older torch
+        # builds have no fp16 matmul on CPU.
+        if VERIFY:
+            x = torch.randn(hidden_size)
+            qkv = torch.nn.functional.linear(x, qkv_matrix.float(), qkv_bias.float())
+            qkv = qkv.view(num_heads, 3 * head_size)
+            for W_x, b_x, i in ((Wq_x, bq, 0), (Wk_x, bk, 1), (Wv_x, bv, 2)):
+                expected = qkv[..., i*head_size:(i+1)*head_size].reshape(-1)
+                actual = torch.nn.functional.linear(x, W_x.float(), b_x.float())
+                assert torch.allclose(expected, actual, atol=1e-4)
+
+    return layer, Wq_x, Wk_x, Wv_x, bq, bk, bv
+
+# The fused tensors are popped here, on the main thread, so the workers never
+# touch list_vars. They are handed over through generators rather than lists,
+# so each one is only referenced by its executor work item and is freed as
+# soon as that layer has been split.
+layers = range(hparams["num_hidden_layers"])
+qkv_weights = (list_vars.pop("gpt_neox.layers." + str(layer) + ".attention.query_key_value.weight") for layer in layers)
+qkv_biases = (list_vars.pop("gpt_neox.layers." + str(layer) + ".attention.query_key_value.bias") for layer in layers)
+
+# Layers are independent, so split them in parallel and stitch the results
+# back in layer order (which keeps the tensor order in the file).
+with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+    results = list(ex.map(split_layer, layers, qkv_weights, qkv_biases))
+
+for layer, Wq_x, Wk_x, Wv_x, bq, bk, bv in results:
+    # Save the new weights and biases
+    list_vars["gpt_neox.layers." + str(layer) + ".attention.query.weight"] = Wq_x
+    list_vars["gpt_neox.layers." + str(layer) + ".attention.key.weight"] = Wk_x
+    list_vars["gpt_neox.layers." + str(layer) + ".attention.value.weight"] = Wv_x
+    list_vars["gpt_neox.layers." + str(layer) + ".attention.query.bias"] = bq
+    list_vars["gpt_neox.layers." + str(layer) + ".attention.key.bias"] = bk
+    list_vars["gpt_neox.layers." + str(layer) + ".attention.value.bias"] = bv
+del results, Wq_x, Wk_x, Wv_x, bq, bk, bv
+
+# buffers that the ggml model doesn't load
+SKIP = ('attention.masked_bias', 'attention.rotary_emb.inv_freq', 'attention.bias')
+names = [name for name in list_vars
+         if not (name.startswith('gpt_neox.layers.') and any(s in name for s in SKIP))]
+
+for name in names:
+    data = list_vars[name].detach().squeeze()
+
+    n_dims = data.dim()
+    if VERBOSE:
+        print(name, n_dims, tuple(data.shape))
 
     # default type is fp32
+    # cast in torch so an fp16 checkpoint is never round-tripped through fp32
     ftype_cur = 0
     if ftype == 1 and n_dims > 1:
-        print("  Converting to float16", data.shape, data[:3, :3].tolist())
-        data = data.astype(np.float16)
+        if VERBOSE:
+            print("  Converting to float16", tuple(data.shape))
+        data = data.to(torch.float16, copy=False)
         ftype_cur = 1
     else:
-        print("  Converting to float32", data.shape, data[:3].tolist())
-        data = data.astype(np.float32)
+        if VERBOSE:
+            print("  Converting to float32", tuple(data.shape))
+        data = data.to(torch.float32, copy=False)
 
     # header
     str = name.encode('utf-8')
-    fout.write(struct.pack("iii", n_dims, len(str), ftype_cur))
-    for i in range(n_dims):
-        fout.write(struct.pack("i", data.shape[n_dims - 1 - i]))
-    print(str)
-    fout.write(str)
-
-    # data
-    data.tofile(fout)
+    header = header_struct(n_dims).pack(n_dims, len(str), ftype_cur, *reversed(data.shape)) + str
+
+    # data (a zero-copy numpy view of the tensor)
+    write_tensor(fout, header, data.contiguous().numpy())
+
+    # drop the tensor once it is on disk
+    del data, list_vars[name]
 
 fout.close()
 